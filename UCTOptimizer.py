@@ -1,13 +1,34 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # simple optimization algorithm for tuning parameters using UCT
-from random import uniform, randrange, sample
+from random import Random
+from multiprocessing import Pool, cpu_count
 import subprocess
+import pickle
+import warnings
 from math import sqrt, log
 
 APP_PATH="./test_uct_optimizer.py"
 
 RUN_COMMAND=APP_PATH
 
+def uct_argmax(wins, visits, parent_visits, c):
+	"""
+	Returns the index of the child with the highest UCT score given the
+	per-child wins and visits. Every child must have been visited at least once.
+	"""
+	lp = log(parent_visits)
+	best = -1
+	best_value = -1e18
+	for i in range(len(wins)):
+		v = visits[i]
+		# one division shared by the win rate and the exploration term
+		inv = 1.0 / v
+		value = wins[i] * inv + c * sqrt(lp * inv)
+		if value > best_value:
+			best_value = value
+			best = i
+	return best
+
 class IntervalNode(object):
 	"""
 	Simple node representing an interval that we are exploring in the tree.
@@ -18,13 +39,18 @@ class IntervalNode(object):
 	"""
 	WIN_RESULTS = {'W': 1, 'L': 0, 'D': 0}
 	
+	# there are a lot of nodes, so don't give each of them a __dict__
+	__slots__ = ('children', 'interval', 'wins', 'visits', 'samples', 'parent', 'uct_coeff',
+				 'num_chunks', 'chunk_width', 'chunk_index', 'child_wins', 'child_visits', 'unvisited_mask', 'rng')
+	
 
-	def __init__(self, interval, uct_coeff, num_chunks):
+	def __init__(self, interval, uct_coeff, num_chunks, rng=None):
 		"""
 		Simple tree node that allows us to iteratively refine
 		the interval.
 		The interval chunks sort of correspond to actions and a particular
 		interval corresponds to states.
+		The random generator is shared by the whole tree.
 		"""
 		self.children 		= [None for i in range(num_chunks)] # initialize to none
 		self.interval	    = interval
@@ -34,6 +60,17 @@ class IntervalNode(object):
 		self.parent 		= None
 		self.uct_coeff 		= uct_coeff
 		self.num_chunks 	= num_chunks
+		self.chunk_width 	= self.interval_width / num_chunks # the interval never changes
+		self.chunk_index 	= None # our index in the parent's children
+		
+		# wins and visits of each child kept side by side so best_child can scan them directly
+		self.child_wins 	= [0] * num_chunks
+		self.child_visits 	= [0] * num_chunks
+		
+		# bit i is set while the child for chunk i has not been inflated
+		self.unvisited_mask = (1 << num_chunks) - 1
+		
+		self.rng 			= rng if rng is not None else Random()
 		
 	def random_subinterval(self):
 		"""
@@ -42,57 +79,27 @@ class IntervalNode(object):
 		"""
 		
 		# get the left hand side starting range
-		chunk = randrange(self.num_chunks)
+		chunk = self.rng.randrange(self.num_chunks)
 		
-		return (chunk, chunk * self.chunk_width, (chunk + 1) * self.chunk_width)
+		return (chunk, self.interval[0] + chunk * self.chunk_width, self.interval[0] + (chunk + 1) * self.chunk_width)
 	
-	def is_root(self):
-		"""Checks whether or not we are a root node by checking if we have an interval set"""
-		return self.interval is None or self.parent is None
-	
-	def inflate_random_child(self):
+	def best_child(self):
 		"""
-		Should be called when we have not examined all the intervals.
-		One option might be to inflate all the children but only set
-		their visits count to zero?
+		Finds the best child representing an action. We hit each kid at least once, so
+		while some haven't been inflated yet a random one of them is created here and
+		comes back with no visits. After that the child with the highest UCT score wins.
 		"""
-		# if we have inflated all the children don't continue
-		if self.visits > self.num_chunks:
-			return None
-			
-		print "Visits: %d" % (self.visits, )
-		
-		# create a list of indicies of unvisited nodes
-		unvisited = []
-		
-		for index in range(self.num_chunks):
-			if self.children[index] is None:
-				unvisited.append(index)
-				
-		# pick a random unvisisted sub_interval index
-		rand_chunk_index = sample(unvisited, 1)[0]
-		
-		#if a child doesn't already exist, we make a new one
-		node = self.make_child_for_interval(rand_chunk_index)
-			
-		return node
-		
-	def best_child(self):
-		"""Finds the best child representing an actino"""
-		if len(self.children) == 0:
-			return None
+		mask = self.unvisited_mask
+		if mask:
+			# pick a random unvisited sub_interval index
+			unvisited = [index for index in range(self.num_chunks) if mask >> index & 1]
+			return self.make_child_for_interval(self.rng.choice(unvisited))
 		
-		if len(filter(lambda child: child is None, self.children)) > 0:
-			# we should hit each kid at least once.
-			# grab one of the unvisited children.
-			# the calling code should then call inflateNewChild
-			return None
-		else:
-			# if we have visited all the children, then we should simply take the one with the highest UCT score
-			return max(self.children, key=lambda child: child.uct_value)
+		index = uct_argmax(self.child_wins, self.child_visits, self.visits, self.uct_coeff)
+		return self.children[index]
 	
 	def most_visited_child(self):
-		children = filter(lambda child: child is not None, self.children)
+		children = [child for child in self.children if child is not None]
 		if len(children) == 0:
 			return None
 		return max(children, key=lambda child: child.visits)
@@ -101,13 +108,12 @@ class IntervalNode(object):
 		"""Descends the tree picking the best child at every step"""
 		cur_node = self
 		
-		# just follow the best nodes down the root
-		while cur_node.has_children:
+		# just follow the best nodes down the root until we run out of inflated children
+		while True:
 			best_child = cur_node.most_visited_child()
-			if best_child is not None:
-				cur_node = best_child
-			else:
+			if best_child is None:
 				break
+			cur_node = best_child
 
 		return cur_node.interval
 	
@@ -116,110 +122,235 @@ class IntervalNode(object):
 		"""Gets the total interval width"""
 		return self.interval[1] - self.interval[0]
 		
-	@property
-	def chunk_width(self):
-		"""Gets the width of each subinterval"""
-		return self.interval_width / self.num_chunks
-		
 	def make_child_for_interval(self, interval_index):
 		"""Adds a new child if it doesn't already exist for the given interval index"""
 		if self.children[interval_index] is not None:
 			return self.children[interval_index]
 			
-		self.children[interval_index] = IntervalNode((self.interval[0] + interval_index * self.chunk_width, self.interval[0] + (interval_index + 1) * self.chunk_width), self.uct_coeff, self.num_chunks)
+		lo = self.interval[0]
+		width = self.chunk_width
+		child = IntervalNode((lo + interval_index * width, lo + (interval_index + 1) * width), self.uct_coeff, self.num_chunks, self.rng)
 		
 		# now add the child to ourselves
-		self.add_child(self.children[interval_index], interval_index)
+		self.add_child(child, interval_index)
 		
-		return self.children[interval_index]
+		return child
 		
 	def has_child_for_interval(self, interval):
 		"""Checks to see if we have inflated a child for a given interval index"""
 		return self.children[interval] is None
 	
-	@property
-	def uct_value(self):
-		""" Computes the UCT ranking for this node. Should only be called on children node (never the root)"""
-		if self.is_root():
-			return None
-			
-		# compute the UCT value. We bias our win rate based on our parents visits and our own visits
-		return (float(self.wins) / float(self.visits)) + self.uct_coeff * sqrt(log(self.parent.visits) / self.visits)
-	
-	@property
-	def has_children(self):
-		return len(self.children) > 0
-	
-	@property
-	def is_leaf(self):
-		return not self.has_children
-
 	def __repr__(self):
-		def repr_indented(node, tabs):
-			children = ""
+		return '%i/%i@<%.5f, %.5f>' % (self.wins, self.visits, self.interval[0], self.interval[1])
+	
+	def dump_tree(self, max_depth=None):
+		"""Renders this node and everything below it, one node per line indented by depth"""
+		lines = []
+		def dump(node, depth):
+			lines.append('\t' * depth + repr(node))
+			if max_depth is not None and depth >= max_depth:
+				return
 			for child in node.children:
 				if child is not None:
-					children += tabs + repr_indented(child, tabs + '\t') + '\n'
-			return '%i/%i@<%.5f, %.5f> :\n%s' % (node.wins, node.visits, node.interval[0], node.interval[1], children)
-		return repr_indented(self, '\t')
+					dump(child, depth + 1)
+		dump(self, 0)
+		return '\n'.join(lines)
 		
 	def propegate_result(self, result):
 		"""Propegates the UCT results back up the tree. The tuple should be the parameter, the value, and the result."""
-		self.visits += 1
-		
-		# update based on result
-		self.wins += self.WIN_RESULTS[result[2]]
+		# only the sampled node keeps the sample itself
 		self.samples.append(result)
+		win = self.WIN_RESULTS[result[2]]
 		
 		# propegates the result up the tree
-		if self.parent is not None:
-			self.parent.propegate_result(result)
+		node = self
+		while node is not None:
+			node.visits += 1
+			node.wins += win
+			parent = node.parent
+			if parent is not None:
+				parent.child_visits[node.chunk_index] += 1
+				parent.child_wins[node.chunk_index] += win
+			node = parent
+	
+	def add_virtual_loss(self):
+		"""
+		Counts a pending sample as a loss all the way up the tree so that the
+		next selection pass in the same batch is pushed towards other arms.
+		"""
+		node = self
+		while node is not None:
+			node.visits += 1
+			if node.parent is not None:
+				node.parent.child_visits[node.chunk_index] += 1
+			node = node.parent
+	
+	def remove_virtual_loss(self):
+		"""Undoes add_virtual_loss once the real result is known"""
+		node = self
+		while node is not None:
+			node.visits -= 1
+			if node.parent is not None:
+				node.parent.child_visits[node.chunk_index] -= 1
+			node = node.parent
+			
+	def merge(self, other):
+		"""Adds the statistics of another tree over the same interval into this one"""
+		self.wins += other.wins
+		self.visits += other.visits
+		self.samples.extend(other.samples)
+		
+		for index, child in enumerate(other.children):
+			if child is None:
+				continue
+			
+			if self.children[index] is None:
+				# we never went here, so just take their subtree
+				self.add_child(child, index)
+			else:
+				self.children[index].merge(child)
+				self.child_wins[index] = self.children[index].wins
+				self.child_visits[index] = self.children[index].visits
 			
 	def add_child(self, child, chunk_index):
 		"""Sets the child at the specified chunk index"""
 		self.children[chunk_index] = child
+		self.child_wins[chunk_index] = child.wins
+		self.child_visits[chunk_index] = child.visits
 		child.parent = self
+		child.chunk_index = chunk_index
+		self.unvisited_mask &= ~(1 << chunk_index)
 
 
 class UCTOptimizer(object):
 	"""Uses UCT to optimize the values of a number of parameters"""
 	
-	def __init__(self, test_program, iterations, uct_coeff):
+	def __init__(self, test_program, iterations, uct_coeff, seed=None, persistent=False):
+		"""
+		The test program is either a command line to run for every game or a
+		callable taking the parameter name and value and returning 'W', 'L' or 'D'.
+		If persistent is set the command is only started once per concurrent game and
+		is then sent one 'name value' line per game, answering with one result line.
+		A callable has to be picklable (e.g. a module level function) to search
+		more than one tree in parallel, see num_trees.
+		The seed is used for the sample points and for expanding the tree.
+		"""
 		self.test_program = test_program
 		self.iterations   = iterations
 		self.uct_coeff	  = uct_coeff
 		self.num_chunks   = 10 # number of chunks on each level
 		self.horizen 	  = 20 # the depth of the tree. Ideally we should calculate this based on the desired precision
+		self.batch_size   = cpu_count() # number of games run concurrently
 		self.samples_loss = []
 		self.samples_win  = []
+		self.verbose 	  = False # print progress while tuning
+		self.rng 		  = Random(seed)
+		self.num_trees 	  = 1 # independent trees searched in parallel and merged at the end, needs a picklable test program
+		
+		# split the command once rather than for every game
+		self._argv = None if callable(test_program) else test_program.split()
+		self.persistent   = persistent
+		self._procs 	  = [] # running test programs when persistent
 		
 	def sample(self, node, param):
 		"""Takes a 'sample' by running a game using the parameters within this node's interval"""
+		return self.sample_batch([node], param)[0]
+	
+	def sample_batch(self, nodes, param):
+		"""
+		Samples each of the nodes by running the games for all of them concurrently.
+		Returns the list of results in the same order as the nodes.
+		"""
 		
-		# take a uniform point from the interval
-		p = uniform(node.interval[0], node.interval[1])
+		# take a uniform point from each interval
+		uniform = self.rng.uniform
+		points = [uniform(node.interval[0], node.interval[1]) for node in nodes]
 		
-		# concatenate the list of parameters with keys and values
-		param_str = '%s %.5f' % (param, p)
+		if callable(self.test_program):
+			# the games run in process so there is nothing to overlap
+			outcomes = [self.test_program(param, p) for p in points]
+		else:
+			outcomes = self.run_games(param, points)
 		
-		# build the command for sampling
-		command = self.test_program + ' ' + param_str
+		results = []
+		for node, p, win_loss in zip(nodes, points, outcomes):
+			if win_loss == 'W':
+				self.samples_win.append(p)
+			else:
+				self.samples_loss.append(p)
+
+			if self.verbose:
+				print('Sampled: %s' % (win_loss, ))
+			# inform the node about the samples
+			node.propegate_result((param, p, win_loss))
+			results.append(win_loss)
 		
-		try:
-			win_loss = subprocess.check_output(command.split(' ')).strip()
-		except subprocess.CalledProcessError as e:
-			win_loss = e.output.strip()
+		return results
+	
+	def run_games(self, param, points):
+		"""Runs the test program once for each point concurrently and returns the outputs"""
+		if self.persistent:
+			# programs we start here are only kept running for this call, so don't start more than we use
+			started = not self._procs
+			self.start_games(min(self.batch_size, len(points)))
+			try:
+				return self.run_persistent_games(param, points)
+			finally:
+				if started:
+					self.stop_games()
 		
-		if win_loss == 'W':
-			self.samples_win.append(p)
-		else:
-			self.samples_loss.append(p)
-
-		print 'Sampled: %s' % (win_loss, )
-		# inform the node about the samples
-		node.propegate_result((param, p, win_loss))
+		# start all of the games before waiting on any of them
+		procs = []
+		for p in points:
+			# add the parameter key and value to the command
+			argv = self._argv + [param, '%.5f' % p]
+			
+			procs.append(subprocess.Popen(argv, stdout=subprocess.PIPE, universal_newlines=True))
 		
-		return win_loss
+		return [proc.communicate()[0].strip() for proc in procs]
+	
+	def run_persistent_games(self, param, points):
+		"""Plays the games on the long running test programs, in rounds of one game per program"""
+		num_procs = len(self._procs)
+		outputs = []
+		for start in range(0, len(points), num_procs):
+			round_points = points[start:start + num_procs]
+			
+			# hand each running program one game before reading any of the answers
+			for proc, p in zip(self._procs, round_points):
+				proc.stdin.write('%s %.5f\n' % (param, p))
+				proc.stdin.flush()
+			
+			for proc, p in zip(self._procs, round_points):
+				line = proc.stdout.readline()
+				if not line:
+					raise RuntimeError("test program '%s' (pid %d) exited instead of answering a game"
+									   % (' '.join(self._argv), proc.pid))
+				outputs.append(line.strip())
+		
+		return outputs
+	
+	def start_games(self, count=None):
+		"""
+		Starts the long running test programs if they aren't running yet. By default
+		there is one per concurrent game.
+		"""
+		if self._procs:
+			return
+		
+		if count is None:
+			count = self.batch_size
+		
+		for i in range(count):
+			self._procs.append(subprocess.Popen(self._argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+												bufsize=1, universal_newlines=True))
+	
+	def stop_games(self):
+		"""Closes the input of the long running test programs and waits for them to exit"""
+		for proc in self._procs:
+			proc.stdin.close()
+			proc.wait()
+		self._procs = []
 
 	def output_mathematica(self, l):
 		c = "{"
@@ -236,6 +367,54 @@ class UCTOptimizer(object):
 		Tunes parameters should be list of tuples (name, start, end) against the program.
 		Returns the tuned parameters.
 		"""
+		if self.num_trees > 1 and not self.can_search_in_parallel():
+			warnings.warn("test program %r can't be pickled for the process pool, searching a single tree instead"
+						  % (self.test_program, ))
+			root = self.build_tree(params)
+		elif self.num_trees > 1:
+			root = self.build_trees_parallel(params)
+		else:
+			root = self.build_tree(params)
+		
+		if self.verbose:
+			print(root.dump_tree())
+
+		# now find the best interval
+		best_interval = root.find_best_interval()
+		return (params[0][0], best_interval[0], best_interval[1])
+	
+	def can_search_in_parallel(self):
+		"""Checks whether the test program can be sent to the process pool used by build_trees_parallel"""
+		try:
+			pickle.dumps(self.test_program)
+		except (pickle.PicklingError, AttributeError, TypeError):
+			return False
+		return True
+	
+	def build_trees_parallel(self, params):
+		"""
+		Splits the iterations over num_trees independent trees searched in a process pool
+		and merges them into a single tree. Returns the merged root.
+		"""
+		num_trees = self.num_trees
+		seeds = [self.rng.getrandbits(32) for i in range(num_trees)]
+		budgets = [self.iterations // num_trees + (1 if i < self.iterations % num_trees else 0) for i in range(num_trees)]
+		
+		with Pool(min(num_trees, cpu_count())) as pool:
+			results = pool.map(_run_single_tree, [(self, seed, iterations, params) for seed, iterations in zip(seeds, budgets)])
+		
+		root = results[0][0]
+		for tree, samples_win, samples_loss in results[1:]:
+			root.merge(tree)
+		
+		for tree, samples_win, samples_loss in results:
+			self.samples_win.extend(samples_win)
+			self.samples_loss.extend(samples_loss)
+		
+		return root
+	
+	def build_tree(self, params):
+		"""Runs the UCT search for the configured number of iterations and returns the root"""
 		# start at the root and just work our way down
 		# split into top level interval nodes
 		# right now we only use one parameter but we'd like to use others in the future
@@ -243,44 +422,77 @@ class UCTOptimizer(object):
 		
 		chunk = (p1[2] - p1[1]) / self.num_chunks
 		
-		root = IntervalNode((p1[1], p1[2]), self.uct_coeff, self.num_chunks)
+		root = IntervalNode((p1[1], p1[2]), self.uct_coeff, self.num_chunks, self.rng)
+		
+		# in process games run one after another, so batching them would only leave
+		# every selection but the first working from stale statistics
+		batch_size = 1 if callable(self.test_program) else self.batch_size
+		
+		# keep the long running test programs up for the whole search rather than one batch
+		if self.persistent and self._argv is not None:
+			self.start_games()
 		
 		# now we simply start exploring the tree
 		# do we pick a random arm or do we explore the arm further?
-		cur_node 	= root
-		parent_node = root
-		
 		# run up and down the tree the specified number of iterations
-		for iterations in xrange(self.iterations):
-			cur_node = parent_node = root
-			
-			print "Iteration %d" % (iterations, )
-			# run down the tree until we hit a node without all of it's children expanded
-			# or we hit a leaf node and want to expand the tree
-			while cur_node is not None:
-				print "heading down the tree"
-				# the best child call will also tend to inflate other children at the same level
-				# it returns None if we need to inflate a child
-				parent_node = cur_node
-				cur_node = parent_node.best_child()
-
-			# oops! we've fallen out of the tree. Randomly add a new if we are at a leaf node with a new sample.
-			# no notion of "playouts" unless we thought about fixed tree depth
-			new_child = parent_node.inflate_random_child()
-			
-			self.sample(new_child, p1[0])
+		try:
+			for iterations in range(0, self.iterations, batch_size):
+				if self.verbose:
+					print("Iteration %d" % (iterations, ))
+				
+				# collect a batch of leaves to sample at once. Each pending leaf carries a
+				# virtual loss so that the following descents spread out over other arms.
+				leaves = []
+				for batch_index in range(min(batch_size, self.iterations - iterations)):
+					# run down the tree until the best child is one we just inflated
+					# no notion of "playouts" unless we thought about fixed tree depth
+					new_child = root.best_child()
+					while new_child.visits > 0:
+						if self.verbose:
+							print("heading down the tree")
+						new_child = new_child.best_child()
+					
+					if self.verbose:
+						print("Visits: %d" % (new_child.parent.visits, ))
+					new_child.add_virtual_loss()
+					leaves.append(new_child)
+				
+				for leaf in leaves:
+					leaf.remove_virtual_loss()
+				
+				self.sample_batch(leaves, p1[0])
+		finally:
+			self.stop_games()
 		
-		print root
+		return root
 
-		print self.output_mathematica(self.samples_win)
-		print self.output_mathematica(self.samples_loss)
 
-		# now find the best interval
-		best_interval = root.find_best_interval()
-		return (params[0][0], best_interval[0], best_interval[1])
+def _run_single_tree(args):
+	"""Builds one of the trees for build_trees_parallel. Lives at the top level so the pool can pickle it."""
+	tuner, seed, iterations, params = args
+	
+	tuner.iterations   = iterations
+	tuner.batch_size   = 1 # the pool already keeps every core busy, and a small tree needs feedback after each game
+	tuner.rng 		   = Random(seed)
+	tuner.samples_win  = []
+	tuner.samples_loss = []
+	
+	root = tuner.build_tree(params)
+	return (root, tuner.samples_win, tuner.samples_loss)
 		
 if __name__ == "__main__":
-	tuner = UCTOptimizer(RUN_COMMAND, 400, 0.3)
+	import sys
+	
+	if '--command' in sys.argv[1:]:
+		# play the games on long running copies of the test program instead of in process
+		tuner = UCTOptimizer(RUN_COMMAND, 400, 0.3, persistent=True)
+	else:
+		from test_uct_optimizer import evaluate
+		
+		tuner = UCTOptimizer(evaluate, 400, 0.3)
+	tuner.num_trees = max(1, min(cpu_count(), tuner.iterations // 100)) # leave each tree at least 100 games
 	params = tuner.tune_params([('k', 0.0, 1000.0)])
 	
-	print params
+	print(tuner.output_mathematica(tuner.samples_win))
+	print(tuner.output_mathematica(tuner.samples_loss))
+	print(params)
@@ -1,21 +1,31 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # simple script to test the UCT optimizer
 
 from random import gauss, random
 import sys
 
-p = random()
+def evaluate(name, k):
+	"""Plays a single game with the parameter set to k. Returns 'W' or 'L'."""
+	p = random()
 
-k = float(sys.argv[2])
+	if k <= 500:
+		prob = -k*(k - 500.0)/(62500.0)
+	else:
+		prob = -(k - 500.0)*(k - 1000.0)/(2*62500.0)
 
-if k <= 500:
-    prob = -k*(k - 500.0)/(62500.0)
-else:
-    prob = -(k - 500.0)*(k - 1000.0)/(2*62500.0)
+	#print k, prob
 
-#print k, prob
+	if p < prob:
+		return 'W'
+	else:
+		return 'L'
 
-if p < prob:
-	print 'W'
-else:
-	print 'L'
+if __name__ == "__main__":
+	if len(sys.argv) > 2:
+		print(evaluate(sys.argv[1], float(sys.argv[2])))
+	else:
+		# without arguments keep playing one game per 'name value' line until stdin closes
+		for line in sys.stdin:
+			name, k = line.split()
+			print(evaluate(name, float(k)))
+			sys.stdout.flush()